@@ -112,6 +112,11 @@ def add_train_3_args(parser):
     parser.add_argument('--lr_decay_by', type=float, default=0.9)
     parser.add_argument('--lr_decay_every', type=float, default=500)
     parser.add_argument('--non_variational', action='store_true', default=False, help='make the variational autoencoder non-variational')
+    parser.add_argument('--accum_steps', type=int, default=1, help='number of batches to accumulate gradients over before each optimizer step (lr_decay_every then counts optimizer steps, not batches)')
+    parser.add_argument('--num_workers', type=int, default=4, help='number of DataLoader worker processes (0 loads data in the main process)')
+    parser.add_argument('--amp', action='store_true', default=False, help='run the point encoder in mixed precision (cuda only)')
+    parser.add_argument('--compile', action='store_true', default=False, help='compile the point encoder with torch.compile (PyTorch 2.x)')
+    parser.add_argument('--recompute_decoder', action='store_true', default=False, help='recompute the frozen decoder activations during backward (gradient checkpointing) to save memory')
 
     # loss weights
     parser.add_argument('--loss_weight_geo', type=float, default=2.0, help='weight for the geo recon loss')
@@ -134,6 +139,7 @@ def add_train_3_args(parser):
     parser.add_argument('--no_console_log', action='store_true', default=False)
     parser.add_argument('--console_log_interval', type=int, default=3, help='number of optimization steps beween console log prints')
     parser.add_argument('--checkpoint_interval', type=int, default=500, help='number of optimization steps beween checkpoints')
+    parser.add_argument('--overwrite', action='store_true', default=False, help='delete an existing training run with the same name instead of aborting')
 
     # load pretrained model (for pc exps)
     parser.add_argument('--stage_2_name', type=str, help='resume model exp name')
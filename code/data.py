@@ -5,6 +5,7 @@
 import sys
 import os
 import json
+import hashlib
 import torch
 import numpy as np
 from torch.utils import data
@@ -39,6 +40,26 @@ def normalize_point_cloud_torch(point_cloud):
     
     return normalized_point_cloud
 
+def normalize_geo_channels_first(geo):
+    """
+    标准化点云并转换为 PointNet 的输入布局 (B, 3, N)，保证内存连续，
+    这样批量拼接后 Conv1d 不再需要逐节点 permute。
+    """
+    return normalize_point_cloud_torch(geo).transpose(1, 2).contiguous()
+
+def geo_hash_key(norm_geo):
+    """
+    计算标准化点云的哈希值 (基于 float16 字节，相当于量化后比较)，
+    相同的部件 (如对称的椅子腿) 得到相同的 key，训练时只需编码一次。
+    """
+    return hashlib.blake2b(norm_geo.detach().cpu().numpy().tobytes(), digest_size=16).digest()
+
+def _set_norm_geo(node, hash_geo=False):
+    # 标准化后的坐标在 [-1, 1] 内，以 float16 存储即可，减半内存和 H2D 传输量
+    node.norm_geo = normalize_geo_channels_first(node.geo).half()
+    if hash_geo:
+        node.norm_geo_key = geo_hash_key(node.norm_geo)
+
 # store a part hierarchy of graphs for a shape
 class Tree(object):
 
@@ -77,7 +98,11 @@ class Tree(object):
             self.part_id = part_id          # part_id in result_after_merging.json of PartNet
             self.box = box                  # box parameter for all nodes
             self.geo = geo                  # 1 x 1000 x 3 point cloud
-            self.norm_geo = normalize_point_cloud(geo) if geo is not None else None
+            self.norm_geo = normalize_geo_channels_first(geo) if geo is not None else None
+                                            # 1 x 3 x 1000 normalized point cloud (channels first,
+                                            # float16 when loaded by PartNetDataset)
+            self.norm_geo_key = None        # hash of norm_geo, shared by identical parts
+                                            # (only set by PartNetDataset.load_object)
             self.geo_feat = geo_feat        # 1 x 100 geometry feature
             self.label = label              # node semantic label at the current level
             self.full_label = full_label    # node semantic label from root (separated by slash)
@@ -140,18 +165,35 @@ class Tree(object):
             box = np.hstack([center, size, rotmat[:, 0].flatten(), rotmat[:, 1].flatten()]).astype(np.float32)
             self.box = torch.from_numpy(box).view(1, -1)
             
-        def to(self, device):
+        def to(self, device, non_blocking=False):
+            if self.box is not None:
+                self.box = self.box.to(device, non_blocking=non_blocking)
+            for edge in self.edges:
+                if 'params' in edge:
+                    edge['params'] = edge['params'].to(device, non_blocking=non_blocking)
+            if self.geo is not None:
+                self.geo = self.geo.to(device, non_blocking=non_blocking)
+                self.norm_geo = self.norm_geo.to(device, non_blocking=non_blocking)
+
+            for child_node in self.children:
+                child_node.to(device, non_blocking=non_blocking)
+
+            return self
+
+        # called by the DataLoader when pin_memory=True, so that the later
+        # non_blocking host-to-device copies can overlap with compute
+        def pin_memory(self):
             if self.box is not None:
-                self.box = self.box.to(device)
+                self.box = self.box.pin_memory()
             for edge in self.edges:
                 if 'params' in edge:
-                    edge['params'].to(device)
+                    edge['params'] = edge['params'].pin_memory()
             if self.geo is not None:
-                self.geo = self.geo.to(device)
-                self.norm_geo = self.norm_geo.to(device)
+                self.geo = self.geo.pin_memory()
+                self.norm_geo = self.norm_geo.pin_memory()
 
             for child_node in self.children:
-                child_node.to(device)
+                child_node.pin_memory()
 
             return self
 
@@ -314,8 +356,12 @@ class Tree(object):
     def __init__(self, root):
         self.root = root
 
-    def to(self, device):
-        self.root = self.root.to(device)
+    def to(self, device, non_blocking=False):
+        self.root = self.root.to(device, non_blocking=non_blocking)
+        return self
+
+    def pin_memory(self):
+        self.root = self.root.pin_memory()
         return self
 
     def __str__(self):
@@ -342,10 +388,11 @@ class Tree(object):
 # extend torch.data.Dataset class for PartNet
 class PartNetDataset(data.Dataset):
 
-    def __init__(self, root, object_list, data_features, load_geo=False):
+    def __init__(self, root, object_list, data_features, load_geo=False, hash_geo=False):
         self.root = root
         self.data_features = data_features
         self.load_geo = load_geo
+        self.hash_geo = hash_geo        # set Node.norm_geo_key, only read by stage-3 training
 
         if isinstance(object_list, str):
             with open(os.path.join(self.root, object_list), 'r') as f:
@@ -356,7 +403,7 @@ class PartNetDataset(data.Dataset):
     def __getitem__(self, index):
         if 'object' in self.data_features:
             obj = self.load_object(os.path.join(self.root, self.object_names[index]+'.json'), \
-                    load_geo=self.load_geo)
+                    load_geo=self.load_geo, hash_geo=self.hash_geo)
 
         data_feats = ()
         for feat in self.data_features:
@@ -374,11 +421,11 @@ class PartNetDataset(data.Dataset):
 
     def get_anno_id(self, anno_id):
         obj = self.load_object(os.path.join(self.root, anno_id+'.json'), \
-                load_geo=self.load_geo)
+                load_geo=self.load_geo, hash_geo=self.hash_geo)
         return obj
 
     @staticmethod
-    def load_object(fn, load_geo=False):
+    def load_object(fn, load_geo=False, hash_geo=False):
         if load_geo:
             geo_fn = fn.replace('_hier', '_geo').replace('json', 'npz')
             geo_data = np.load(geo_fn)
@@ -406,11 +453,11 @@ class PartNetDataset(data.Dataset):
 
             if 'geo' in node_json.keys():
                 node.geo = torch.tensor(np.array(node_json['geo']), dtype=torch.float32).view(1, -1, 3)
-                node.norm_geo = normalize_point_cloud_torch(node.geo)
+                _set_norm_geo(node, hash_geo=hash_geo)
 
             if load_geo:
                 node.geo = torch.tensor(geo_data['parts'][node_json['id']], dtype=torch.float32).view(1, -1, 3)
-                node.norm_geo = normalize_point_cloud_torch(node.geo)
+                _set_norm_geo(node, hash_geo=hash_geo)
 
 
             if 'box' in node_json:
@@ -462,7 +509,8 @@ class PartNetDataset(data.Dataset):
 
             if node.geo is not None:
                 node_json['geo'] = node.geo.cpu().numpy().reshape(-1).tolist()
-                node_json['normgeo'] = node.norm_geo.cpu().numpy().reshape(-1).tolist()
+                # recompute from geo in fp32, norm_geo may be stored in float16
+                node_json['normgeo'] = normalize_point_cloud_torch(node.geo).cpu().numpy().reshape(-1).tolist()
 
             if node.box is not None:
                 node_json['box'] = node.box.cpu().numpy().reshape(-1).tolist()
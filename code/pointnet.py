@@ -127,8 +127,8 @@ class PointNetEncoder(nn.Module):
         self.fc2 = nn.Linear(512, 256)
         self.dropout = nn.Dropout(p=0.3)
 
+    # x: B x 3 x N point clouds, channels first as consumed by the Conv1d stack
     def forward(self, x):
-        x = x.permute(0, 2, 1)
         x, trans, trans_feat = self.feat(x)
         x = F.relu(self.fc1(x))
         return F.relu(self.dropout(self.fc2(x)))
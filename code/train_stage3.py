@@ -3,18 +3,24 @@
     Use scripts/train_ae_pc_chair.sh or scripts/train_vae_pc_chair.sh to run.
     Before that, you need to run scripts/pretrain_part_pc_ae_chair.sh or scripts/pretrain_part_pc_vae_chair.sh
     to pretrain part geometry AE/VAE.
+    For multi-GPU training, launch with torchrun --nproc_per_node=N train_stage3.py ...
 """
 
 import os
 import time
 import sys
 import shutil
+import contextlib
 import random
 from time import strftime
 from argparse import ArgumentParser
 import numpy as np
 import torch
 import torch.utils.data
+import torch.utils.checkpoint
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.utils.data.distributed import DistributedSampler
 from config import add_train_3_args
 from data import PartNetDataset, Tree
 import utils
@@ -25,26 +31,27 @@ from pointnet import PointNetEncoder
 torch.set_num_threads(2)
 
 
-def forward_one_node(obj_node, pointencoder, decoder, losses):
-    # Pointnet++ Encoder
-    root_code = pointencoder(obj_node.norm_geo)
-    # Node Decoder
-    obj_losses, _, _ = decoder.node_recon_loss(root_code, obj_node)
-    # loss cal
-    for loss_name, loss in obj_losses.items():
-        losses[loss_name] = losses[loss_name] + loss
-    return losses
+# order of the per-node loss vector, the loss weights follow the same order
+LOSS_KEYS = ('latent', 'geo', 'center', 'scale', 'leaf', 'exists', 'semantic', 'edge_exists', 'sym', 'adj')
 
-def forward_one_obj(obj_node, pointnet, decoder, losses, cnt):
+def forward_one_node(obj_node, node_code, decoder, recompute=False):
+    # Node Decoder (frozen, gradients only flow back to node_code)
+    if recompute:
+        obj_losses, _, _ = torch.utils.checkpoint.checkpoint(
+            decoder.node_recon_loss, node_code, obj_node, use_reentrant=False)
+    else:
+        obj_losses, _, _ = decoder.node_recon_loss(node_code, obj_node)
+    # loss cal: stack into a single [len(LOSS_KEYS)] vector
+    # (sym / adj are plain python zeros for nodes without such edges)
+    return torch.stack([torch.as_tensor(obj_losses[k], dtype=torch.float32, device=node_code.device).reshape(()) \
+            for k in LOSS_KEYS])
 
-    # 对当前节点的 geo 进行操作，并将结果添加到 losses 中
-    losses = forward_one_node(obj_node, pointnet, decoder, losses)
-    cnt += 1
-    # 如果有子节点，则递归遍历子节点
-    if obj_node.children:
-        for child in obj_node.children:
-            losses, cnt = forward_one_obj(child, pointnet, decoder, losses, cnt)  # 递归处理子节点，并将结果扩展到 losses 中
-    return losses, cnt
+def worker_init_fn(worker_id):
+    # torch derives a distinct, seed-dependent base seed for every worker;
+    # reuse it so numpy / random stay reproducible across worker processes
+    seed = torch.initial_seed() % 2**32
+    random.seed(seed)
+    np.random.seed(seed)
 
 
 
@@ -53,23 +60,36 @@ def train(conf):
     # load network model
     models = utils.get_model_module(conf.model_version)
 
-    # check if training run already exists. If so, delete it.
-    if os.path.exists(os.path.join(conf.log_path, conf.exp_name)) or \
-       os.path.exists(os.path.join(conf.model_path, conf.exp_name)):
-        response = input('A training run named "%s" already exists, overwrite? (y/n) ' % (conf.exp_name))
-        if response != 'y':
-            sys.exit()
-    if os.path.exists(os.path.join(conf.log_path, conf.exp_name)):
-        shutil.rmtree(os.path.join(conf.log_path, conf.exp_name))
-    if os.path.exists(os.path.join(conf.model_path, conf.exp_name)):
-        shutil.rmtree(os.path.join(conf.model_path, conf.exp_name))
-
-    # create directories for this run
-    os.makedirs(os.path.join(conf.model_path, conf.exp_name))
-    os.makedirs(os.path.join(conf.log_path, conf.exp_name))
-
-    # file log
-    flog = open(os.path.join(conf.log_path, conf.exp_name, 'train.log'), 'w')
+    # distributed training (launched with torchrun): one process per GPU,
+    # only the first process writes logs and checkpoints
+    distributed = int(os.environ.get('WORLD_SIZE', 1)) > 1
+    rank = 0
+    if distributed:
+        dist.init_process_group('nccl')
+        rank = dist.get_rank()
+        local_rank = int(os.environ['LOCAL_RANK'])
+        torch.cuda.set_device(local_rank)
+        conf.device = f'cuda:{local_rank}'
+        if rank != 0:
+            conf.no_console_log = True
+            conf.no_tb_log = True
+
+    if rank == 0:
+        # check if training run already exists. If so, delete it (only with --overwrite,
+        # never prompt so that batch jobs don't block on stdin)
+        run_dirs = [os.path.join(conf.model_path, conf.exp_name), os.path.join(conf.log_path, conf.exp_name)]
+        if any(os.path.exists(run_dir) for run_dir in run_dirs) and not conf.overwrite:
+            sys.exit('A training run named "%s" already exists, pass --overwrite to replace it.' % (conf.exp_name))
+
+        # create directories for this run
+        for run_dir in run_dirs:
+            shutil.rmtree(run_dir, ignore_errors=True)
+            os.makedirs(run_dir)
+
+        # file log
+        flog = open(os.path.join(conf.log_path, conf.exp_name, 'train.log'), 'w')
+    else:
+        flog = open(os.devnull, 'w')
 
     # set training device
     device = torch.device(conf.device)
@@ -83,6 +103,11 @@ def train(conf):
     # control randomness
     if conf.seed < 0:
         conf.seed = random.randint(1, 10000)
+    if distributed:
+        # all processes need the same seed, otherwise their DistributedSampler shards overlap
+        seed = torch.tensor([conf.seed], dtype=torch.long, device=device)
+        dist.broadcast(seed, src=0)
+        conf.seed = int(seed.item())
     print("Random Seed: %d" % (conf.seed))
     flog.write(f'Random Seed: {conf.seed}\n')
     random.seed(conf.seed)
@@ -90,7 +115,8 @@ def train(conf):
     torch.manual_seed(conf.seed)
 
     # save config
-    torch.save(conf, os.path.join(conf.model_path, conf.exp_name, 'conf.pth'))
+    if rank == 0:
+        torch.save(conf, os.path.join(conf.model_path, conf.exp_name, 'conf.pth'))
 
     # create models
     encoder = models.RecursiveEncoder(conf, variational=True, probabilistic=not conf.non_variational)
@@ -117,7 +143,10 @@ def train(conf):
         param.requires_grad = False
 
     # create optimizers
-    point_opt = torch.optim.Adam(encoder.parameters(), lr=conf.lr)
+    point_opt = torch.optim.Adam(pointencoder.parameters(), lr=conf.lr)
+
+    # loss scaling for mixed precision training of the point encoder (no-op when disabled)
+    scaler = torch.cuda.amp.GradScaler(enabled=conf.amp and device.type == 'cuda')
 
     # learning rate scheduler
     point_scheduler = torch.optim.lr_scheduler.StepLR(point_opt, \
@@ -126,15 +155,25 @@ def train(conf):
     # create training and validation datasets and data loaders
     data_features = ['object']
     train_dataset = PartNetDataset(conf.data_path, conf.train_dataset, data_features, \
-            load_geo=conf.load_geo)
+            load_geo=conf.load_geo, hash_geo=True)
     valdt_dataset = PartNetDataset(conf.data_path, conf.val_dataset, data_features, \
-            load_geo=conf.load_geo)
+            load_geo=conf.load_geo, hash_geo=True)
+    # pinned batches let obj.to(device, non_blocking=True) overlap the copy with compute,
+    # worker processes load and build the trees while the GPU is busy
+    loader_kwargs = dict(collate_fn=utils.collate_feats, pin_memory=device.type == 'cuda', \
+            num_workers=conf.num_workers, worker_init_fn=worker_init_fn)
+    if conf.num_workers > 0:
+        loader_kwargs.update(persistent_workers=True, prefetch_factor=4)
+    # every process works on its own shard of the datasets
+    train_sampler = DistributedSampler(train_dataset, seed=conf.seed) if distributed else None
+    valdt_sampler = DistributedSampler(valdt_dataset, seed=conf.seed) if distributed else None
     train_dataloader = torch.utils.data.DataLoader(train_dataset, batch_size=conf.batch_size, \
-            shuffle=True, collate_fn=utils.collate_feats)
+            shuffle=train_sampler is None, sampler=train_sampler, **loader_kwargs)
     valdt_dataloader = torch.utils.data.DataLoader(valdt_dataset, batch_size=conf.batch_size, \
-            shuffle=True, collate_fn=utils.collate_feats)
+            shuffle=valdt_sampler is None, sampler=valdt_sampler, **loader_kwargs)
 
     # create logs
+    train_writer, valdt_writer = None, None
     if not conf.no_console_log:
         header = '     Time    Epoch     Dataset    Iteration    Progress(%)      LR       LatentLoss    GeoLoss   CenterLoss   ScaleLoss   StructLoss  EdgeExists   SymLoss   AdjLoss   TotalLoss'
     if not conf.no_tb_log:
@@ -148,6 +187,20 @@ def train(conf):
         m.to(device)
     pointencoder.to(device)
 
+    # the point encoder is the only trainable module, so only its gradients are all-reduced.
+    # fuse its pointwise ops with torch.compile; the number of nodes changes from batch
+    # to batch, so shapes are left dynamic. checkpoints and the optimizer keep using the
+    # unwrapped module so the saved state_dict keys don't change
+    point_net = pointencoder
+    if distributed:
+        point_net = ddp_net = DDP(point_net, device_ids=[local_rank])
+    if conf.compile:
+        point_net = torch.compile(point_net)
+
+    # loss weights, in the order of LOSS_KEYS
+    loss_weights = torch.tensor([getattr(conf, f'loss_weight_{k}') for k in LOSS_KEYS], \
+            dtype=torch.float32, device=device)
+
     # start training
     print("Starting training ...... ")
     flog.write('Starting training ......\n')
@@ -166,6 +219,10 @@ def train(conf):
             print(header)
             flog.write(header+'\n')
 
+        if distributed:
+            train_sampler.set_epoch(epoch)
+            valdt_sampler.set_epoch(epoch)
+
         train_batches = enumerate(train_dataloader, 0)
         valdt_batches = enumerate(valdt_dataloader, 0)
 
@@ -182,29 +239,38 @@ def train(conf):
             if log_console:
                 last_train_console_log_step = train_step
 
-            # make sure the models are in eval mode to deactivate BatchNorm for PartEncoder and PartDecoder
-            # there are no other BatchNorm / Dropout in the rest of the network
-            # for m in models:
-            #     m.eval()
-
-            # forward pass (including logging)
-            total_loss = forward(
-                batch=batch, data_features=data_features,point=pointencoder, encoder=encoder, decoder=decoder, device=device, conf=conf,
-                is_valdt=False, step=train_step, epoch=epoch, batch_ind=train_batch_ind, num_batch=train_num_batch, start_time=start_time,
-                log_console=log_console, log_tb=not conf.no_tb_log, tb_writer=train_writer,
-                lr=point_opt.param_groups[0]['lr'], flog=flog)
+            # the frozen encoder / decoder stay in eval mode, the point encoder has to be
+            # switched back to train mode since validation runs in between training batches
+            pointencoder.train()
+
+            # gradients are accumulated over conf.accum_steps batches (and the last batch of the epoch)
+            # before each optimizer step; DDP only needs to all-reduce them on the stepping batch
+            optimize_step = (train_batch_ind + 1) % conf.accum_steps == 0 or train_batch_ind + 1 == train_num_batch
+            # the last group of an epoch may be shorter than conf.accum_steps
+            accum_start = train_batch_ind - train_batch_ind % conf.accum_steps
+            accum_size = min(conf.accum_steps, train_num_batch - accum_start)
+            with ddp_net.no_sync() if distributed and not optimize_step else contextlib.nullcontext():
+                # forward pass (including logging)
+                total_loss = forward(
+                    batch=batch, data_features=data_features,point=point_net, decoder=decoder, device=device, conf=conf, loss_weights=loss_weights,
+                    is_valdt=False, step=train_step, epoch=epoch, batch_ind=train_batch_ind, num_batch=train_num_batch, start_time=start_time,
+                    log_console=log_console, log_tb=not conf.no_tb_log, tb_writer=train_writer,
+                    lr=point_opt.param_groups[0]['lr'], flog=flog)
+
+                scaler.scale(total_loss / accum_size).backward()
 
             # optimize one step
-            point_opt.step()
-            point_scheduler.step()
-            point_opt.zero_grad()
-            total_loss.backward()
+            if optimize_step:
+                scaler.step(point_opt)
+                scaler.update()
+                point_scheduler.step()
+                point_opt.zero_grad(set_to_none=True)
 
 
             # save checkpoint
             with torch.no_grad():
-                if last_checkpoint_step is None or \
-                        train_step - last_checkpoint_step >= conf.checkpoint_interval:
+                if rank == 0 and (last_checkpoint_step is None or \
+                        train_step - last_checkpoint_step >= conf.checkpoint_interval):
                     print("Saving checkpoint ...... ", end='', flush=True)
                     flog.write("Saving checkpoint ...... ")
                     utils.save_checkpoint(
@@ -231,119 +297,112 @@ def train(conf):
                     m.eval()
                 pointencoder.eval()
 
+                # stays on the current stream: the chamfer extension used by the decoder
+                # launches its kernels on the legacy default stream
                 with torch.no_grad():
                     # forward pass (including logging)
                     __ = forward(
-                        batch=batch, data_features=data_features, point=pointencoder, encoder=encoder, decoder=decoder, device=device, conf=conf,
+                        batch=batch, data_features=data_features, point=point_net, decoder=decoder, device=device, conf=conf, loss_weights=loss_weights,
                         is_valdt=True, step=valdt_step, epoch=epoch, batch_ind=valdt_batch_ind, num_batch=valdt_num_batch, start_time=start_time,
                         log_console=log_console, log_tb=not conf.no_tb_log, tb_writer=valdt_writer,
                         lr=point_opt.param_groups[0]['lr'], flog=flog)
 
     # save the final models
-    print("Saving final checkpoint ...... ", end='', flush=True)
-    flog.write("Saving final checkpoint ...... ")
-    utils.save_checkpoint(
-        models=models, model_names=model_names, dirname=os.path.join(conf.model_path, conf.exp_name),
-        epoch=epoch, prepend_epoch=False, optimizers=[point_opt], optimizer_names=["pointencoder"])
-    print("DONE")
-    flog.write("DONE\n")
+    if rank == 0:
+        print("Saving final checkpoint ...... ", end='', flush=True)
+        flog.write("Saving final checkpoint ...... ")
+        utils.save_checkpoint(
+            models=models, model_names=model_names, dirname=os.path.join(conf.model_path, conf.exp_name),
+            epoch=epoch, prepend_epoch=False, optimizers=[point_opt], optimizer_names=["pointencoder"])
+        print("DONE")
+        flog.write("DONE\n")
 
     flog.close()
 
-def forward(batch, data_features, point, encoder, decoder, device, conf,
+    if distributed:
+        dist.destroy_process_group()
+
+def forward(batch, data_features, point, decoder, device, conf, loss_weights,
             is_valdt=False, step=None, epoch=None, batch_ind=0, num_batch=1, start_time=0,
             log_console=False, log_tb=False, tb_writer=None, lr=None, flog=None):
     objects = batch[data_features.index('object')]
 
-    losses = {
-        'latent': torch.zeros(1, device=device),
-        'geo': torch.zeros(1, device=device),
-        'center': torch.zeros(1, device=device),
-        'scale': torch.zeros(1, device=device),
-        'leaf': torch.zeros(1, device=device),
-        'exists': torch.zeros(1, device=device),
-        'semantic': torch.zeros(1, device=device),
-        'edge_exists': torch.zeros(1, device=device),
-        'sym': torch.zeros(1, device=device),
-        'adj': torch.zeros(1, device=device)}
-
     # process every data in the batch individually
-    cnt = 0
+    nodes = []
     for obj in objects:
-        obj.to(device)
-        root_code = encoder.encode_structure(obj=obj)
-        # 遍历整个obj，然后返回Loss
-        losses, cnt = forward_one_obj(obj.root, point, decoder, losses, cnt)
-
-    for loss_name in losses.keys():
-        losses[loss_name] = losses[loss_name] / cnt
-
-    losses['latent'] *= conf.loss_weight_latent
-    losses['geo'] *= conf.loss_weight_geo
-    losses['center'] *= conf.loss_weight_center
-    losses['scale'] *= conf.loss_weight_scale
-    losses['leaf'] *= conf.loss_weight_leaf
-    losses['exists'] *= conf.loss_weight_exists
-    losses['semantic'] *= conf.loss_weight_semantic
-    losses['edge_exists'] *= conf.loss_weight_edge_exists
-    losses['sym'] *= conf.loss_weight_sym
-    losses['adj'] *= conf.loss_weight_adj
-
-    total_loss = 0
-    for loss in losses.values():
-        total_loss += loss
+        obj.to(device, non_blocking=True)
+        # 遍历整个obj，收集所有节点 (iterative, no python frame per node)
+        nodes.extend(obj.depth_first_traversal())
+    cnt = len(nodes)
+
+    # identical parts (e.g. symmetric legs) have the same normalized point cloud,
+    # only encode every distinct one (by the hash the dataset computes at load time) once
+    geo_index = dict()
+    unique_geos = []
+    node2geo = []
+    for node in nodes:
+        # nodes without a hash are never merged with any other node
+        geo_key = node.norm_geo_key if node.norm_geo_key is not None else id(node)
+        if geo_key not in geo_index:
+            geo_index[geo_key] = len(unique_geos)
+            unique_geos.append(node.norm_geo)
+        node2geo.append(geo_index[geo_key])
+
+    # Pointnet++ Encoder: encode the point clouds of all nodes in the batch in a single pass
+    # only the point encoder runs under autocast, the frozen decoder (chamfer kernels,
+    # hungarian matching) keeps consuming fp32 codes.
+    # norm_geo is stored and transferred as float16, it is upcast once on the device
+    node_geos = torch.cat(unique_geos, dim=0).float()  # N x 3 x P
+    with torch.cuda.amp.autocast(enabled=conf.amp and device.type == 'cuda'):
+        node_codes = point(node_geos)
+    node_codes = node_codes.float()
+    if len(unique_geos) < len(nodes):
+        # scatter the codes back to all nodes, gradients of shared codes are summed
+        node_codes = node_codes[torch.tensor(node2geo, dtype=torch.long, device=device)]
+    node_losses = [forward_one_node(node, node_code, decoder, recompute=conf.recompute_decoder) \
+            for node, node_code in zip(nodes, node_codes.split(1))]
+    # sum all nodes with a single op instead of a chain of N additions
+    loss_vec = torch.stack(node_losses).sum(dim=0)
+
+    # average over all nodes and apply the loss weights in one go
+    loss_vec = loss_vec / cnt * loss_weights
+    total_loss = loss_vec.sum()
+    log_tb = log_tb and tb_writer is not None
+    if not (log_console or log_tb):
+        return total_loss
 
     with torch.no_grad():
+        # copy all loss values to the host with a single device sync
+        losses = dict(zip(LOSS_KEYS + ('total',), torch.cat([loss_vec, total_loss.view(1)]).tolist()))
+
         # log to console
         if log_console:
-            print(
-                f'''{strftime("%H:%M:%S", time.gmtime(time.time()-start_time)):>9s} '''
-                f'''{epoch:>5.0f}/{conf.epochs:<5.0f} '''
-                f'''{'validation' if is_valdt else 'training':^10s} '''
-                f'''{batch_ind:>5.0f}/{num_batch:<5.0f} '''
-                f'''{100. * (1+batch_ind+num_batch*epoch) / (num_batch*conf.epochs):>9.1f}%      '''
-                f'''{lr:>5.2E} '''
-                f'''{losses['latent'].item():>11.2f} '''
-                f'''{losses['geo'].item():>11.2f} '''
-                f'''{losses['center'].item():>11.2f} '''
-                f'''{losses['scale'].item():>11.2f} '''
-                f'''{(losses['leaf']+losses['exists']+losses['semantic']).item():>11.2f} '''
-                f'''{losses['edge_exists'].item():>11.2f} '''
-                f'''{losses['sym'].item():>10.2f} '''
-                f'''{losses['adj'].item():>10.2f} '''
-                f'''{total_loss.item():>10.2f}''')
-            flog.write(
-                f'''{strftime("%H:%M:%S", time.gmtime(time.time()-start_time)):>9s} '''
-                f'''{epoch:>5.0f}/{conf.epochs:<5.0f} '''
-                f'''{'validation' if is_valdt else 'training':^10s} '''
-                f'''{batch_ind:>5.0f}/{num_batch:<5.0f} '''
-                f'''{100. * (1+batch_ind+num_batch*epoch) / (num_batch*conf.epochs):>9.1f}%      '''
-                f'''{lr:>5.2E} '''
-                f'''{losses['latent'].item():>11.2f} '''
-                f'''{losses['geo'].item():>11.2f} '''
-                f'''{losses['center'].item():>11.2f} '''
-                f'''{losses['scale'].item():>11.2f} '''
-                f'''{(losses['leaf']+losses['exists']+losses['semantic']).item():>11.2f} '''
-                f'''{losses['edge_exists'].item():>11.2f} '''
-                f'''{losses['sym'].item():>10.2f} '''
-                f'''{losses['adj'].item():>10.2f} '''
-                f'''{total_loss.item():>10.2f}\n''')
+            log_line = \
+                f'''{strftime("%H:%M:%S", time.gmtime(time.time()-start_time)):>9s} ''' \
+                f'''{epoch:>5.0f}/{conf.epochs:<5.0f} ''' \
+                f'''{'validation' if is_valdt else 'training':^10s} ''' \
+                f'''{batch_ind:>5.0f}/{num_batch:<5.0f} ''' \
+                f'''{100. * (1+batch_ind+num_batch*epoch) / (num_batch*conf.epochs):>9.1f}%      ''' \
+                f'''{lr:>5.2E} ''' \
+                f'''{losses['latent']:>11.2f} ''' \
+                f'''{losses['geo']:>11.2f} ''' \
+                f'''{losses['center']:>11.2f} ''' \
+                f'''{losses['scale']:>11.2f} ''' \
+                f'''{losses['leaf']+losses['exists']+losses['semantic']:>11.2f} ''' \
+                f'''{losses['edge_exists']:>11.2f} ''' \
+                f'''{losses['sym']:>10.2f} ''' \
+                f'''{losses['adj']:>10.2f} ''' \
+                f'''{losses['total']:>10.2f}'''
+            print(log_line)
+            flog.write(log_line + '\n')
             flog.flush()
 
         # log to tensorboard
-        if log_tb and tb_writer is not None:
-            tb_writer.add_scalar('loss', total_loss.item(), step)
+        if log_tb:
+            tb_writer.add_scalar('loss', losses['total'], step)
             tb_writer.add_scalar('lr', lr, step)
-            tb_writer.add_scalar('latent_loss', losses['latent'].item(), step)
-            tb_writer.add_scalar('geo_loss', losses['geo'].item(), step)
-            tb_writer.add_scalar('center_loss', losses['center'].item(), step)
-            tb_writer.add_scalar('scale_loss', losses['scale'].item(), step)
-            tb_writer.add_scalar('leaf_loss', losses['leaf'].item(), step)
-            tb_writer.add_scalar('exists_loss', losses['exists'].item(), step)
-            tb_writer.add_scalar('semantic_loss', losses['semantic'].item(), step)
-            tb_writer.add_scalar('edge_exists_loss', losses['edge_exists'].item(), step)
-            tb_writer.add_scalar('sym_loss', losses['sym'].item(), step)
-            tb_writer.add_scalar('adj_loss', losses['adj'].item(), step)
+            for loss_name in LOSS_KEYS:
+                tb_writer.add_scalar(f'{loss_name}_loss', losses[loss_name], step)
 
     return total_loss
 